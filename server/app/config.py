@@ -25,6 +25,9 @@ class Settings(BaseSettings):
     host: str = Field(default="0.0.0.0", env="HOST")
     port: int = Field(default=8000, env="PORT")
     
+    esms_binary_frames: bool = Field(default=False, env="ESMS_BINARY_FRAMES")
+    esms_outbox_limit: int = Field(default=1024, env="ESMS_OUTBOX_LIMIT")
+    
     class Config:
         env_file = Path(__file__).parent / ".env"
         case_sensitive = False
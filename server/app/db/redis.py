@@ -1,5 +1,5 @@
 from json import JSONDecodeError, dumps, loads
-from typing import Optional, Any, Dict
+from typing import Optional, Any, Dict, List
 import redis.asyncio as aioredis
 import logging
 
@@ -99,6 +99,18 @@ class Redis:
             logger.error(f"Failed to get key {key}: {e}")
             return None
     
+    async def mget(self, *keys: str) -> List[Optional[Any]]:
+        assert self._client
+        
+        if not keys:
+            return []
+        
+        try:
+            return await self._client.mget(keys)
+        except Exception as e:
+            logger.error(f"Failed to get keys {keys}: {e}")
+            return [None] * len(keys)
+    
     async def delete(self, *keys: str) -> int:
         assert self._client
         
@@ -108,6 +120,15 @@ class Redis:
             logger.error(f"Failed to delete keys {keys}: {e}")
             return 0
     
+    async def unlink(self, *keys: str) -> int:
+        assert self._client
+        
+        try:
+            return await self._client.unlink(*keys)
+        except Exception as e:
+            logger.error(f"Failed to unlink keys {keys}: {e}")
+            return 0
+    
     async def exists(self, *keys: str) -> int:
         assert self._client
         
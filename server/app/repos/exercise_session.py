@@ -1,24 +1,84 @@
 from typing import Optional, List, Dict, Any, Tuple, Union
 from datetime import datetime, timezone
-import json
 import logging
+import orjson
 
 from app.db.redis import Redis
 from app.db.mongo import Mongo
-from app.schema.exercise_session import ExerciseSessionInDB, ExerciseSessionState, ExerciseSessionStatus, ExerciseSession, ExerciseSessionParticipant, ExerciseSessionInvitation
+from app.schema.exercise_session import (
+    ExerciseSessionInDB, ExerciseSessionState, ExerciseSessionStatus, ExerciseSession, ExerciseSessionParticipant, ExerciseSessionInvitation,
+    ExerciseSessionStateItem, ExerciseSessionStateItemType, ExerciseSessionItemMeta, ExerciseType, ExerciseSessionStateItemSet,
+    ExerciseSetType, ExerciseSessionStateItemMetric, Weight, WeightUnit, Duration, Distance, DistanceUnit,
+)
 
 collection_name = "exercise_sessions"
 state_key = "exercise_session_state"
 
+# writes ARGV[2] only if the stored state is still at version ARGV[1], returns 0 when another writer got there first
+update_state_if_version_lua = """
+local raw = redis.call("GET", KEYS[1])
+if not raw then return 0 end
+local version = cjson.decode(raw).version
+if version == nil or version == cjson.null then version = 0 end
+if version ~= tonumber(ARGV[1]) then return 0 end
+redis.call("SET", KEYS[1], ARGV[2], "EX", ARGV[3])
+return 1
+"""
+
 logger = logging.getLogger(__name__)
 
 def build_state_key(session_id: str, account_id: str) -> str:
     return f"{state_key}:{session_id}:{account_id}"
 
+def _load_metric(d: Dict[str, Any]) -> ExerciseSessionStateItemMetric:
+    weight = d.get("weight")
+    duration = d.get("duration")
+    distance = d.get("distance")
+    return ExerciseSessionStateItemMetric.construct(
+        reps=d.get("reps"),
+        weight=Weight.construct(value=weight["value"], unit=WeightUnit(weight["unit"])) if weight else None,
+        duration=Duration.construct(value=duration["value"]) if duration else None,
+        distance=Distance.construct(value=distance["value"], unit=DistanceUnit(distance["unit"])) if distance else None,
+    )
+
+def _load_state(d: Dict[str, Any]) -> ExerciseSessionState:
+    """Rebuild a state cached by this repository without re-validating it, enums are still coerced"""
+    return ExerciseSessionState.construct(
+        session_id=d["session_id"],
+        account_id=d["account_id"],
+        version=d.get("version", 0),
+        items=[
+            ExerciseSessionStateItem.construct(
+                id=i["id"],
+                order=i.get("order", 1),
+                participants=i.get("participants", []),
+                type=ExerciseSessionStateItemType(i["type"]),
+                rest=i.get("rest"),
+                meta=[
+                    ExerciseSessionItemMeta.construct(internal_id=m["internal_id"], name=m["name"], type=ExerciseType(m["type"]))
+                    for m in i.get("meta", [])
+                ],
+                sets=[
+                    ExerciseSessionStateItemSet.construct(
+                        id=st["id"],
+                        meta_id=st["meta_id"],
+                        order=st.get("order", 1),
+                        metrics=_load_metric(st["metrics"]),
+                        type=ExerciseSetType(st["type"]),
+                        complete=st.get("complete", False),
+                    )
+                    for st in i.get("sets", [])
+                ],
+            )
+            for i in d.get("items", [])
+        ],
+    )
+
 class ExerciseSessionRepository:
     def __init__(self, mongo: Mongo, redis: Redis):
         self.mongo = mongo
         self.redis = redis
+        self._update_state_script = None
 
     async def get_session_by_id(self, session_id: str) -> Optional[ExerciseSessionInDB]:
         doc = await self.mongo.find_one_by_id(collection=collection_name, document_id=session_id)
@@ -60,30 +120,29 @@ class ExerciseSessionRepository:
         if not session.participants:
             return []
 
+        if not session.id:
+            return []
+
+        keys = [build_state_key(session.id, p.id) for p in session.participants]
+        raws = await self.redis.mget(*keys)
+
         states: List[ExerciseSessionState] = []
-        for p in session.participants:
-            if not session.id:
-                continue
-            
-            key = build_state_key(session.id, p.id)
-            
-            raw = await self.redis.get(key)
+        for p, key, raw in zip(session.participants, keys, raws):
             if not raw:
                 continue
 
             try:
-                s = raw.decode("utf-8") if isinstance(raw, (bytes, bytearray)) else raw
-                data = json.loads(s)
-                state = ExerciseSessionState.parse_obj(data)
-                sid = getattr(state, "session_id", None)
-                if sid and str(sid) != str(session_id):
+                data = orjson.loads(raw)
+                state = _load_state(data)
+                sid = state.session_id
+                if sid and sid != session_id:
                     logger.debug(
                         "Skipping state for %s: mismatched session_id (%s != %s)",
                         p.id, sid, session_id
                     )
                     continue
                 states.append(state)
-            except json.JSONDecodeError as e:
+            except orjson.JSONDecodeError as e:
                 logger.warning("Bad JSON for participant %s (key=%s): %s", p.id, key, e)
             except Exception as e:
                 logger.warning("Bad state for participant %s (key=%s): %s", p.id, key, e)
@@ -103,11 +162,10 @@ class ExerciseSessionRepository:
             return None
 
         try:
-            s = raw.decode("utf-8") if isinstance(raw, (bytes, bytearray)) else raw
-            data = json.loads(s)
-            state = ExerciseSessionState.parse_obj(data)
-            return state if getattr(state, "session_id", None) in (None, str(session.id)) else None
-        except json.JSONDecodeError as e:
+            data = orjson.loads(raw)
+            state = _load_state(data)
+            return state if state.session_id == session.id else None
+        except orjson.JSONDecodeError as e:
             logger.warning("Bad active state JSON for %s: %s", account_id, e)
             return None
         except Exception as e:
@@ -185,13 +243,24 @@ class ExerciseSessionRepository:
         raw = new_state.json(exclude_none=True)
         await self.redis.set(key, raw, ex=3600)
 
+    async def update_session_state_if_version(self, new_state: ExerciseSessionState, expected_version: int) -> bool:
+        """Write a state only if the stored copy is still at expected_version, False means it changed or expired"""
+        client = self.redis.get_client()
+        script = self._update_state_script
+        if script is None or script.registered_client is not client:
+            script = self._update_state_script = client.register_script(update_state_if_version_lua)
+        
+        key = build_state_key(new_state.session_id, new_state.account_id)
+        raw = new_state.json(exclude_none=True)
+        return bool(await script(keys=[key], args=[expected_version, raw, 3600]))
+
     async def delete_session(self, session_id: str) -> bool:
         res = await self.mongo.delete_by_id(collection=collection_name, document_id=session_id)
         return bool(getattr(res, "deleted_count", 0))
 
     async def delete_session_state(self, session_id: str, account_id: str) -> bool:
         key = build_state_key(session_id=session_id, account_id=account_id)
-        res = await self.redis.delete(key)
+        res = await self.redis.unlink(key)
         return bool(res)
 
     async def invite(self, session_id: str, invited_by_account_id: str, invited_account_id: str) -> bool:
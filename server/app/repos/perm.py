@@ -386,12 +386,7 @@ class RoleRepository:
             if not roles:
                 return False
             
-            all_permissions = {p for r in roles for p in r.permissions}
-            
-            if Permission.ADMIN in all_permissions:
-                return True
-            
-            return permission in all_permissions
+            return any(Permission.ADMIN in r.permissions or permission in r.permissions for r in roles)
         except Exception as e:
             logger.error(f"Failed to check permission for account {account.id}: {e}")
             return False
\ No newline at end of file
@@ -6,6 +6,7 @@ import json
 from app.repos.exercise_session import ExerciseSessionRepository
 from app.schema.exercise_session import ExerciseSessionStatus
 from app.services.exercise_session_service_v2 import ESMService, ExerciseSessionOperation, ExerciseSessionOperationType
+from app.config import settings
 from app.db.mongo import Mongo
 from app.db.redis import Redis
 from app.deps import get_ws_mongo, get_ws_redis, read_ws_account_id
@@ -22,7 +23,12 @@ def get_esms() -> ESMService:
 
 async def init_esms(db, redis) -> None:
     global _esms
-    _esms = ESMService(db, redis)
+    _esms = ESMService(
+        db,
+        redis,
+        binary_frames=settings.esms_binary_frames,
+        outbox_limit=settings.esms_outbox_limit,
+    )
     await _esms.start()
     _esms.register_default_handlers()
     logger.info("Exercise Session Message Service (ESMS) initialized")
@@ -1,5 +1,4 @@
 from pydantic import BaseModel, Field
-from bson import ObjectId
 from typing import Optional, List
 from enum import Enum
 from datetime import datetime
@@ -40,7 +39,4 @@ class ExerciseMetaInDB(ExerciseMeta):
 
     class Config:
         allow_population_by_field_name = True
-        arbitrary_types_allowed = True
-        json_encoders = {
-            ObjectId: str,
-        }
\ No newline at end of file
+        arbitrary_types_allowed = True
\ No newline at end of file
@@ -1,6 +1,5 @@
 from typing import Optional, List
 from enum import Enum
-from bson import ObjectId
 from datetime import datetime
 from pydantic import BaseModel, Field
 
@@ -40,15 +39,32 @@ class DistanceUnit(str, Enum):
     MILE = "mi"
     YARD = "yd"
 
+_TO_KG = {
+    WeightUnit.KILOGRAM: 1.0,
+    WeightUnit.POUND: 0.453592,
+}
+
+_TO_LB = {
+    WeightUnit.KILOGRAM: 2.20462,
+    WeightUnit.POUND: 1.0,
+}
+
+_TO_METERS = {
+    DistanceUnit.METER: 1.0,
+    DistanceUnit.KILOMETER: 1000.0,
+    DistanceUnit.MILE: 1609.34,
+    DistanceUnit.YARD: 0.9144,
+}
+
 class Weight(BaseModel):
     value: float
     unit: WeightUnit = WeightUnit.POUND
 
     def to_kg(self) -> float:
-        return self.value * 0.453592 if self.unit == WeightUnit.POUND else self.value
+        return self.value * _TO_KG[self.unit]
 
     def to_lb(self) -> float:
-        return self.value * 2.20462 if self.unit == WeightUnit.KILOGRAM else self.value
+        return self.value * _TO_LB[self.unit]
 
 class Duration(BaseModel):
     value: int  # seconds
@@ -58,13 +74,7 @@ class Distance(BaseModel):
     unit: DistanceUnit = DistanceUnit.METER
 
     def to_meters(self) -> float:
-        conv = {
-            DistanceUnit.METER: 1,
-            DistanceUnit.KILOMETER: 1000,
-            DistanceUnit.MILE: 1609.34,
-            DistanceUnit.YARD: 0.9144,
-        }
-        return self.value * conv[self.unit]
+        return self.value * _TO_METERS[self.unit]
 
 class ExerciseSessionParticipantCursor(BaseModel):
     exercise_id: str
@@ -131,7 +141,4 @@ class ExerciseSessionInDB(ExerciseSession):
 
     class Config:
         allow_population_by_field_name = True
-        arbitrary_types_allowed = True
-        json_encoders = {
-            ObjectId: str,
-        }
\ No newline at end of file
+        arbitrary_types_allowed = True
\ No newline at end of file
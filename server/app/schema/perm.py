@@ -1,7 +1,6 @@
 from typing import List
 from enum import Enum
 from pydantic import BaseModel, Field
-from bson import ObjectId
 
 class Permission(str, Enum):
     ADMIN = "admin"                          # Full access to all system features
@@ -23,5 +22,4 @@ class RoleInDB(Role):
 
     class Config:
         allow_population_by_field_name = True
-        json_encoders = { ObjectId: str }
         from_attributes = True
\ No newline at end of file
@@ -1,29 +1,50 @@
-from dataclasses import dataclass
+from collections import defaultdict
+from dataclasses import dataclass, field
 from fastapi import WebSocket
 from pydantic import BaseModel
+from pydantic.json import pydantic_encoder
 from datetime import datetime, timezone
-from typing import Dict, Any, Optional, List, Callable, Awaitable
+from typing import Dict, Any, Optional, List, Callable, Awaitable, Union
 from enum import Enum
 from uuid import uuid4
 import asyncio
 import logging
-import json
+import orjson
+import time
 
 from app.db.mongo import Mongo
 from app.db.redis import Redis
 from app.repos.account import AccountRepository
 from app.repos.exercise import ExerciseMetaRepository
 from app.repos.exercise_session import ExerciseSessionRepository
-from app.schema.account import AccountIdentifier
+from app.schema.account import AccountIdentifier, AccountInDB
 from app.schema.exercise import ExerciseMeta, ExerciseMetaInDB
 from app.schema.exercise_session import ExerciseSessionItemMeta, ExerciseSessionStateItem, ExerciseSessionStateItemType, ExerciseSessionStatus
 
 logger = logging.getLogger(__name__)
 psub_prefix = "esms"
+global_channel = f"{psub_prefix}:global"
+registry_key_prefix = f"{psub_prefix}:connection:"
+publish_batch_max = 256
+publish_batch_max_ms = 2
+session_lock_shards = 64
+cursor_flush_ms = 16
+outbox_limit = 1024
+registry_flush_s = 1
+registry_ttl_s = 300
+registry_refresh_s = 30
+account_cache_ttl_s = 30
+state_write_attempts = 5
+lookup_cache_max = 4096
 
 def _makelog(msg: str) -> str:
     return f"ESMS: {msg}"
 
+def _cache_put(cache: Dict[str, Any], key: str, entry: Any):
+    if len(cache) >= lookup_cache_max:
+        cache.pop(next(iter(cache)))
+    cache[key] = entry
+
 # operation models start
 class ExerciseSessionOperationType(str, Enum):
     JOIN = "join"
@@ -40,6 +61,38 @@ class ExerciseSessionOperationType(str, Enum):
     UPDATE_CURSOR = "update_cursor"
     SESSION_UPDATE = "session_update"
 
+_OP_TYPES = ExerciseSessionOperationType._value2member_map_
+
+_SESSION_ID = ("session_id", "Session ID")
+_EXERCISE_ID = ("exercise_id", "Exercise ID")
+_SET_ID = ("set_id", "Set ID")
+
+# payload keys each operation type must carry, types without an entry take any payload
+_REQUIRED_PAYLOAD_KEYS: dict[ExerciseSessionOperationType, tuple[tuple[str, str], ...]] = {
+    ExerciseSessionOperationType.JOIN: (_SESSION_ID,),
+    ExerciseSessionOperationType.LEAVE: (_SESSION_ID,),
+    ExerciseSessionOperationType.PARTICIPANT_JOIN: (_SESSION_ID,),
+    ExerciseSessionOperationType.PARTICIPANT_LEAVE: (_SESSION_ID,),
+    ExerciseSessionOperationType.ADD_EXERCISE: (_EXERCISE_ID,),
+    ExerciseSessionOperationType.UPDATE_EXERCISE: (_EXERCISE_ID,),
+    ExerciseSessionOperationType.REMOVE_EXERCISE: (_EXERCISE_ID,),
+    ExerciseSessionOperationType.ADD_SET: (_EXERCISE_ID,),
+    ExerciseSessionOperationType.UPDATE_SET: (_EXERCISE_ID, _SET_ID),
+    ExerciseSessionOperationType.REMOVE_SET: (_EXERCISE_ID, _SET_ID),
+    ExerciseSessionOperationType.COMPLETE_SET: (_EXERCISE_ID, _SET_ID),
+    ExerciseSessionOperationType.UPDATE_CURSOR: (_EXERCISE_ID, _SET_ID),
+    ExerciseSessionOperationType.SESSION_UPDATE: (),
+}
+
+# Operations that handle their own broadcasting and should be skipped
+_SKIP_BROADCAST_OPS = frozenset({
+    ExerciseSessionOperationType.JOIN,                  # Handles its own broadcast (sends PARTICIPANT_JOIN)
+    ExerciseSessionOperationType.LEAVE,                 # Handles its own broadcast (sends PARTICIPANT_LEAVE)
+    ExerciseSessionOperationType.PARTICIPANT_JOIN,      # Already a broadcast
+    ExerciseSessionOperationType.PARTICIPANT_LEAVE,     # Already a broadcast
+    ExerciseSessionOperationType.SESSION_UPDATE,        # Direct messages, not broadcasts
+})
+
 class ExerciseSessionOperation(BaseModel):
     id: str
     session_id: str
@@ -80,28 +133,55 @@ class ESMStats:
         }
 # stats models end
 
-@dataclass
+@dataclass(slots=True)
 class ESMConnectionInfo:
     websocket: WebSocket
     account_id: str
     session_id: str
     instance_id: str
     connected_at: datetime
-    last_activity: datetime
+    last_activity: float
+    registry_key: str
+    sent: int = 0
+    sent_seen: int = 0
+    closing: bool = False
+    outbox: asyncio.Queue = field(default_factory=asyncio.Queue)
+    writer_task: Optional[asyncio.Task] = None
 # socket data end
 
 class ESMService:
-    def __init__(self, db: Mongo, redis: Redis, instance_id: Optional[str] = None):
+    def __init__(
+        self,
+        db: Mongo,
+        redis: Redis,
+        instance_id: Optional[str] = None,
+        binary_frames: bool = False,
+        outbox_limit: int = outbox_limit,
+    ):
         self.instance_id = instance_id or str(uuid4())
+        self.binary_frames = binary_frames
+        self.outbox_limit = outbox_limit
         self.db = db
         self.redis = redis
         self.pubsub = None
         self.pubsub_task: Optional[asyncio.Task] = None
-        self._lock = asyncio.Lock()
+        self.publish_task: Optional[asyncio.Task] = None
+        self.cursor_task: Optional[asyncio.Task] = None
+        self.registry_task: Optional[asyncio.Task] = None
+        self._registry_dirty: dict[str, ESMConnectionInfo] = {}
+        self._registry_removed: dict[str, ESMConnectionInfo] = {}
+        self._registry_sessions: dict[str, str] = {}
+        self._account_cache: dict[str, tuple[float, AccountInDB]] = {}
+        self._background_tasks: set[asyncio.Task] = set()
+        self._pending_cursors: dict[tuple[str, str], tuple[str, ExerciseSessionOperation]] = {}
+        self._publish_queue: asyncio.Queue[Optional[tuple[str, Union[str, bytes]]]] = asyncio.Queue()
+        self._session_locks = [asyncio.Lock() for _ in range(session_lock_shards)]
         self.running = False
         self.connections: dict[str, ESMConnectionInfo] = {}
-        self.session_connections: dict[str, set[str]] = {}
-        self.account_connections: dict[str, set[str]] = {}
+        self.session_connections: defaultdict[str, set[str]] = defaultdict(set)
+        self.session_snapshots: dict[str, tuple[str, ...]] = {}
+        self.session_channels: dict[str, str] = {}
+        self.account_connections: defaultdict[str, set[str]] = defaultdict(set)
         self.handlers: Dict[ExerciseSessionOperationType, List[Handler]] = {}
         self.session_repo = ExerciseSessionRepository(db, redis)
         self.account_repo = AccountRepository(db, redis)
@@ -111,105 +191,66 @@ class ESMService:
     
     
     
+    def _slock(self, session_id: str) -> asyncio.Lock:
+        """Get the lock shard guarding a session's connection set"""
+        return self._session_locks[hash(session_id) % session_lock_shards]
+    
+    
+    
+    def _snapshot_session(self, session_id: str):
+        """Rebuild the read-only connection snapshot for a session, caller must hold its shard lock"""
+        connections = self.session_connections.get(session_id)
+        if connections:
+            self.session_snapshots[session_id] = tuple(connections)
+        else:
+            self.session_snapshots.pop(session_id, None)
+    
+    
+    
+    async def _subscribe_session(self, session_id: str):
+        """Subscribe to a session channel, caller must hold its shard lock"""
+        assert self.pubsub is not None
+        
+        channel = self.session_channels[session_id] = f"{psub_prefix}:session:{session_id}"
+        await self.pubsub.subscribe(channel)
+    
+    
+    
+    async def _unsubscribe_session(self, session_id: str):
+        """Unsubscribe from a session channel, caller must hold its shard lock"""
+        channel = self.session_channels.pop(session_id, None) or f"{psub_prefix}:session:{session_id}"
+        if self.pubsub:
+            await self.pubsub.unsubscribe(channel)
+    
+    
+    
+    def _encode(self, operation: ExerciseSessionOperation) -> Union[str, bytes]:
+        """Encode an operation into the frame type sent to clients"""
+        # shallow field map so the payload is serialized by reference instead of deep-copied through .dict()
+        data = orjson.dumps({
+            "id": operation.id,
+            "session_id": operation.session_id,
+            "author_id": operation.author_id,
+            "instance_id": operation.instance_id,
+            "op_type": operation.op_type,
+            "payload": operation.payload,
+            "timestamp": operation.timestamp,
+            "version": operation.version,
+        }, default=pydantic_encoder)
+        return data if self.binary_frames else data.decode()
+    
+    
+    
     def _validate_operation(self, operation: ExerciseSessionOperation):
-        # join
-        if operation.op_type == ExerciseSessionOperationType.JOIN:
-            if not operation.payload:
-                raise ValueError("Payload must be provided for JOIN operation")
-            elif operation.payload.get("session_id") is None:
-                raise ValueError("Session ID must be provided in payload for JOIN operation")
-        
-        # leave
-        if operation.op_type == ExerciseSessionOperationType.LEAVE:
-            if not operation.payload:
-                raise ValueError("Payload must be provided for LEAVE operation")
-            elif operation.payload.get("session_id") is None:
-                raise ValueError("Session ID must be provided in payload for LEAVE operation")
-        
-        # participant join
-        if operation.op_type == ExerciseSessionOperationType.PARTICIPANT_JOIN:
-            if not operation.payload:
-                raise ValueError("Payload must be provided for the PARTICIPANT_JOIN operation")
-            elif operation.payload.get("session_id") is None:
-                raise ValueError("Session ID must be provided in payload for PARTICIPANT_JOIN operation")
-        
-        # participant leave
-        if operation.op_type == ExerciseSessionOperationType.PARTICIPANT_LEAVE:
-            if not operation.payload:
-                raise ValueError("Payload must be provided for the PARTICIPANT_LEAVE operation")
-            elif operation.payload.get("session_id") is None:
-                raise ValueError("Session ID must be provided in payload for PARTICIPANT_LEAVE operation")
-        
-        # add_exercise
-        if operation.op_type == ExerciseSessionOperationType.ADD_EXERCISE:
-            if not operation.payload:
-                raise ValueError("Payload must be provided for ADD_EXERCISE operation")
-            elif operation.payload.get("exercise_id") is None:
-                raise ValueError("Exercise ID must be provided in payload for ADD_EXERCISE operation")
-        
-        # update_exercise
-        if operation.op_type == ExerciseSessionOperationType.UPDATE_EXERCISE:
-            if not operation.payload:
-                raise ValueError("Payload must be provided for UPDATE_EXERCISE operation")
-            elif operation.payload.get("exercise_id") is None:
-                raise ValueError("Exercise ID must be provided in payload for UPDATE_EXERCISE operation")
-        
-        # remove_exercise
-        if operation.op_type == ExerciseSessionOperationType.REMOVE_EXERCISE:
-            if not operation.payload:
-                raise ValueError("Payload must be provided for REMOVE_EXERCISE operation")
-            elif operation.payload.get("exercise_id") is None:
-                raise ValueError("Exercise ID must be provided in payload for REMOVE_EXERCISE operation")
-        
-        # add_set
-        if operation.op_type == ExerciseSessionOperationType.ADD_SET:
-            if not operation.payload:
-                raise ValueError("Payload must be provided for ADD_SET operation")
-            elif operation.payload.get("exercise_id") is None:
-                raise ValueError("Exercise ID must be provided in payload for ADD_SET operation")
-        
-        # update_set
-        if operation.op_type == ExerciseSessionOperationType.UPDATE_SET:
-            if not operation.payload:
-                raise ValueError("Payload must be provided for UPDATE_SET operation")
-            elif operation.payload.get("exercise_id") is None:
-                raise ValueError("Exercise ID must be provided in payload for UPDATE_SET operation")
-            elif operation.payload.get("set_id") is None:
-                raise ValueError("Set ID must be provided in payload for UPDATE_SET operation")
-        
-        # remove_set
-        if operation.op_type == ExerciseSessionOperationType.REMOVE_SET:
-            if not operation.payload:
-                raise ValueError("Payload must be provided for REMOVE_SET operation")
-            elif operation.payload.get("exercise_id") is None:
-                raise ValueError("Exercise ID must be provided in payload for REMOVE_SET operation")
-            elif operation.payload.get("set_id") is None:
-                raise ValueError("Set ID must be provided in payload for REMOVE_SET operation")
-        
-        # complete_set
-        if operation.op_type == ExerciseSessionOperationType.COMPLETE_SET:
-            if not operation.payload:
-                raise ValueError("Payload must be provided for COMPLETE_SET operation")
-            elif operation.payload.get("exercise_id") is None:
-                raise ValueError("Exercise ID must be provided in payload for COMPLETE_SET operation")
-            elif operation.payload.get("set_id") is None:
-                raise ValueError("Set ID must be provided in payload for COMPLETE_SET operation")
-        
-        # update_cursor
-        if operation.op_type == ExerciseSessionOperationType.UPDATE_CURSOR:
-            if not operation.payload:
-                raise ValueError("Payload must be provided for UPDATE_CURSOR operation")
-            elif operation.payload.get("exercise_id") is None:
-                raise ValueError("Exercise ID must be provided in payload for UPDATE_CURSOR operation")
-            elif operation.payload.get("set_id") is None:
-                raise ValueError("Exercise Set ID must be provided in payload for UPDATE_CURSOR operation")
-        
-        # session update
-        if operation.op_type == ExerciseSessionOperationType.SESSION_UPDATE:
-            if not operation.payload:
-                raise ValueError("Payload must be provided for SESSION_UPDATE operation")
-        
-        operation.timestamp = datetime.now(timezone.utc)
+        required = _REQUIRED_PAYLOAD_KEYS.get(operation.op_type)
+        if required is not None:
+            name = operation.op_type.name
+            payload = operation.payload
+            if not payload:
+                raise ValueError(f"Payload must be provided for {name} operation")
+            for key, label in required:
+                if payload.get(key) is None:
+                    raise ValueError(f"{label} must be provided in payload for {name} operation")
     
     
     
@@ -217,8 +258,11 @@ class ESMService:
         """Listen for messages on the pubsub channel and process them"""
         while self.running and self.pubsub is not None:
             try:
-                msg = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
-                if msg and msg.get("type") == "message":
+                async for msg in self.pubsub.listen():
+                    if not self.running:
+                        break
+                    if msg.get("type") != "message":
+                        continue
                     await self._read_op(msg)
             except asyncio.CancelledError:
                 break
@@ -228,76 +272,186 @@ class ESMService:
     
     
     
+    async def _publish(self):
+        """Drain queued broadcasts and publish them to redis in pipelined batches"""
+        queue = self._publish_queue
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            
+            # give concurrent broadcasts a moment to pile up behind this one
+            await asyncio.sleep(publish_batch_max_ms / 1000)
+            
+            batch = [item]
+            done = False
+            while len(batch) < publish_batch_max and not queue.empty():
+                item = queue.get_nowait()
+                if item is None:
+                    done = True
+                    break
+                batch.append(item)
+            
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                for channel, data in batch:
+                    pipe.publish(channel, data)
+                await pipe.execute()
+            except Exception as e:
+                logger.error(_makelog("publish batch of %d failed: %s"), len(batch), e)
+            
+            if done:
+                return
+    
+    
+    
+    async def _flush_cursors(self):
+        """Broadcast the latest pending cursor update of every participant, exiting once none are left"""
+        try:
+            while self.running and self._pending_cursors:
+                await asyncio.sleep(cursor_flush_ms / 1000)
+                
+                pending = self._pending_cursors
+                self._pending_cursors = {}
+                for connection_id, operation in pending.values():
+                    try:
+                        await self.broadcast_operation(operation, exclude_connection=connection_id)
+                    except Exception as e:
+                        logger.error(_makelog("cursor flush failed for %s: %s"), operation.session_id, e)
+        finally:
+            self.cursor_task = None
+    
+    
+    
     async def _read_op(self, op: Dict[str, Any]):
         """Read an operation from the pubsub channel and send it to the appropriate connections"""
         try:
             raw = op.get("data")
             if not raw:
                 raise RuntimeError("Could not find data in pubsub")
-            if isinstance(raw, (bytes, bytearray)):
-                raw = raw.decode("utf-8")
-            
-            converted = ExerciseSessionOperation.parse_raw(raw)
+            if self.binary_frames:
+                frame = raw if isinstance(raw, bytes) else raw.encode()
+            else:
+                frame = raw.decode() if isinstance(raw, bytes) else raw
             
-            if converted.instance_id == self.instance_id:
+            # published by another ESMService instance, so only the routing fields are needed, not a validated model
+            data = orjson.loads(frame)
+            if data.get("instance_id") == self.instance_id:
                 return
             
-            async with self._lock:
-                connections: set[str] = self.session_connections.get(converted.session_id, set())
-                targets = tuple(connections)
-            
+            targets = self.session_snapshots.get(data.get("session_id"), ())
             if not targets:
                 return
             
-            if not connections:
-                return
-            
-            await asyncio.gather(*(self.send_to_connection(cid, converted) for cid in targets), return_exceptions=True)
+            self._fanout(targets, frame)
         except Exception as e:
             logger.error(_makelog("read_op failed: %s"), e)
             raise
     
     
     
-    async def _update_connection_registry(self, connection_id: str, connection: ESMConnectionInfo):
-        """Update the connection registry in redis"""
-        key = f"{psub_prefix}:connection:{connection_id}"
-        data = {
-            "account_id": connection.account_id,
-            "session_id": connection.session_id,
-            "instance_id": connection.instance_id,
-            "connected_at": connection.connected_at.isoformat(),
-            "last_activity": connection.last_activity.isoformat(),
-        }
-        await self.redis.setex(key, 300, json.dumps(data))
+    def _update_connection_registry(self, connection_id: str, connection: ESMConnectionInfo):
+        """Mark a connection's registry entry to be written on the next flush"""
+        self._registry_removed.pop(connection_id, None)
+        self._registry_dirty[connection_id] = connection
+    
+    
+    
+    def _remove_connection_registry(self, connection_id: str, connection: ESMConnectionInfo):
+        """Mark a connection's registry entry to be deleted on the next flush"""
+        self._registry_dirty.pop(connection_id, None)
+        self._registry_removed[connection_id] = connection
+    
+    
     
+    async def _flush_connection_registry(self):
+        """Write pending connection registry changes to redis in a single pipeline"""
+        if not self._registry_dirty and not self._registry_removed:
+            return
+        
+        dirty, self._registry_dirty = self._registry_dirty, {}
+        removed, self._registry_removed = self._registry_removed, {}
+        
+        pipe = self.redis.pipeline(transaction=False)
+        for connection_id, connection in dirty.items():
+            data = {
+                "account_id": connection.account_id,
+                "session_id": connection.session_id,
+                "instance_id": connection.instance_id,
+                "connected_at": connection.connected_at,
+                "last_activity": datetime.fromtimestamp(connection.last_activity, timezone.utc),
+            }
+            pipe.setex(connection.registry_key, registry_ttl_s, orjson.dumps(data))
+            
+            session_id = connection.session_id
+            previous = self._registry_sessions.get(connection_id)
+            if previous and previous != session_id:
+                pipe.srem(f"{psub_prefix}:session:{previous}:connections", connection_id)
+            if session_id:
+                self._registry_sessions[connection_id] = session_id
+                pipe.sadd(f"{psub_prefix}:session:{session_id}:connections", connection_id)
+                pipe.expire(f"{psub_prefix}:session:{session_id}:connections", registry_ttl_s)
+            else:
+                self._registry_sessions.pop(connection_id, None)
+        
+        for connection_id, connection in removed.items():
+            pipe.delete(connection.registry_key)
+            previous = self._registry_sessions.pop(connection_id, None)
+            if previous:
+                pipe.srem(f"{psub_prefix}:session:{previous}:connections", connection_id)
+        
+        try:
+            await pipe.execute()
+        except Exception as e:
+            logger.error(_makelog("registry flush failed: %s"), e)
     
     
-    async def _remove_connection_registry(self, connection_id: str):
-        """Remove the connection registry from redis"""
-        await self.redis.delete(f"{psub_prefix}:connection:{connection_id}")
+    
+    async def _sync_registry(self):
+        """Periodically flush buffered connection registry changes and keep live entries from expiring"""
+        loop = asyncio.get_running_loop()
+        refreshed_at = loop.time()
+        while self.running:
+            await asyncio.sleep(registry_flush_s)
+            if loop.time() - refreshed_at >= registry_refresh_s:
+                refreshed_at = loop.time()
+                now = time.time()
+                for connection in self.connections.values():
+                    if connection.sent != connection.sent_seen:
+                        connection.sent_seen = connection.sent
+                        connection.last_activity = now
+                self._registry_dirty.update(self.connections)
+            await self._flush_connection_registry()
         
     
 
+    async def _get_account(self, account_id: str) -> Optional[AccountInDB]:
+        """Get an account by id, reusing a lookup made within the last account_cache_ttl_s"""
+        now = time.monotonic()
+        cached = self._account_cache.get(account_id)
+        if cached and cached[0] > now:
+            return cached[1]
+        
+        account = await self.account_repo.get_account_by_id(account_id)
+        if account:
+            _cache_put(self._account_cache, account_id, (now + account_cache_ttl_s, account))
+        return account
+    
+    
+    
     async def _assert_session_active(self, session_id: str):
         session = await self.session_repo.get_session_by_id(session_id)
         if not session:
             raise ValueError(f"Session with ID {session_id} does not exist")
 
-        status_val = getattr(session, "status", None)
-        if isinstance(status_val, ExerciseSessionStatus):
-            is_active = status_val == ExerciseSessionStatus.ACTIVE
-        else:
-            is_active = str(status_val) == ExerciseSessionStatus.ACTIVE.value
-        if not is_active:
+        if session.status != ExerciseSessionStatus.ACTIVE:
             raise ValueError(f"Session with ID {session_id} is not active")
         return session
 
 
 
     async def _assert_connection_in_session(self, connection_id: str, session_id: str) -> ESMConnectionInfo:
-        async with self._lock:
-            conn = self.connections.get(connection_id)
+        conn = self.connections.get(connection_id)
         if not conn:
             raise ValueError("Connection not found")
         if conn.session_id != session_id:
@@ -308,44 +462,42 @@ class ESMService:
     
     async def _route_operation(self, connection_id: str, operation: ExerciseSessionOperation):
         """Route a generic ExerciseSessionOperation to its registered handler function and broadcast it"""
-        
-        logger.info("route operation called")
-        logger.info(f"connection_id={connection_id}")
-        logger.info(f"operation={operation.dict()}")
+        logger.debug(_makelog("route %s op=%s from %s"), operation.op_type, operation.id, connection_id)
         for handler in self.handlers.get(operation.op_type, []):
             try:
                 await handler(connection_id, operation)
             except Exception as e:
                 logger.error(_makelog("handler failed for %s: %s"), operation.op_type, e)
         
-        # Operations that handle their own broadcasting and should be skipped
-        skip_broadcast_ops = {
-            ExerciseSessionOperationType.JOIN,                  # Handles its own broadcast (sends PARTICIPANT_JOIN)
-            ExerciseSessionOperationType.LEAVE,                 # Handles its own broadcast (sends PARTICIPANT_LEAVE)
-            ExerciseSessionOperationType.PARTICIPANT_JOIN,      # Already a broadcast
-            ExerciseSessionOperationType.PARTICIPANT_LEAVE,     # Already a broadcast
-            ExerciseSessionOperationType.SESSION_UPDATE,        # Direct messages, not broadcasts
-        }
-    
-        if operation.session_id and operation.op_type not in skip_broadcast_ops:
+        if operation.op_type == ExerciseSessionOperationType.UPDATE_CURSOR and operation.session_id:
+            # cursors move far more often than anyone can see, only the latest per participant gets sent
+            self._pending_cursors[(operation.session_id, operation.author_id)] = (connection_id, operation)
+            # only armed while updates are pending, the task exits once it has drained them
+            if self.cursor_task is None and self.running:
+                self.cursor_task = asyncio.create_task(self._flush_cursors())
+            return
+        
+        if operation.session_id and operation.op_type not in _SKIP_BROADCAST_OPS:
             await self.broadcast_operation(operation, exclude_connection=connection_id)
     
     
     
     async def get_session_connections(self, session_id: str) -> list[dict[str, Any]]:
         """Get all connections for a specific session"""
-        pattern = f"{psub_prefix}:connection:*"
+        client = self.redis.get_client()
+        connection_ids = await client.smembers(f"{psub_prefix}:session:{session_id}:connections")
+        if not connection_ids:
+            return []
+        
         results: list[dict[str, Any]] = []
-        async for key in self.redis.get_client().scan_iter(match=pattern):
-            raw = await self.redis.get(key)
+        for raw in await client.mget([registry_key_prefix + cid for cid in connection_ids]):
             if not raw:
                 continue
-            s = raw.decode("utf-8") if isinstance(raw, (bytes, bytearray)) else raw
             try:
-                data = json.loads(s)
+                data = orjson.loads(raw)
                 if data.get("session_id") == session_id:
                     results.append(data)
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 continue
         return results
     
@@ -358,8 +510,10 @@ class ESMService:
         
         self.running = True
         self.pubsub = self.redis.get_client().pubsub()
-        await self.pubsub.subscribe(f"{psub_prefix}:global")
+        await self.pubsub.subscribe(global_channel)
         self.pubsub_task = asyncio.create_task(self._listen())
+        self.publish_task = asyncio.create_task(self._publish())
+        self.registry_task = asyncio.create_task(self._sync_registry())
         logger.info(_makelog("started"))
     
     
@@ -371,11 +525,34 @@ class ESMService:
         
         self.running = False
         
-        async with self._lock:
-            connections = self.connections
-            
-        for cid in connections:
-            await self.close_connection(cid)
+        await self._close_all_connections()
+        
+        if self.cursor_task:
+            self.cursor_task.cancel()
+            try:
+                await self.cursor_task
+            except asyncio.CancelledError:
+                pass
+            self.cursor_task = None
+        self._pending_cursors.clear()
+        
+        if self.registry_task:
+            self.registry_task.cancel()
+            try:
+                await self.registry_task
+            except asyncio.CancelledError:
+                pass
+            self.registry_task = None
+        await self._flush_connection_registry()
+        
+        if self.publish_task:
+            # flush whatever is still queued before tearing down redis
+            self._publish_queue.put_nowait(None)
+            try:
+                await self.publish_task
+            except Exception:
+                pass
+            self.publish_task = None
         
         if self.pubsub:
             try:
@@ -402,6 +579,29 @@ class ESMService:
     
     
     
+    async def _close_all_connections(self):
+        """Tear down every local connection and session subscription in bulk"""
+        connections = list(self.connections.items())
+        self.connections.clear()
+        self.account_connections.clear()
+        self.stats.open_connections = 0
+        
+        session_ids = list(self.session_connections)
+        self.session_connections.clear()
+        self.session_snapshots.clear()
+        # channels themselves are dropped by the single unsubscribe-all in stop()
+        self.session_channels.clear()
+        
+        for connection_id, connection in connections:
+            self._remove_connection_registry(connection_id, connection)
+            if connection.writer_task:
+                connection.writer_task.cancel()
+        await asyncio.gather(*(connection.websocket.close() for _, connection in connections), return_exceptions=True)
+        
+        logger.info(_makelog("closed %d connections across %d sessions"), len(connections), len(session_ids))
+    
+    
+    
     def register_handler(self, op_type: ExerciseSessionOperationType, handler: Handler):
         """Register a new handler for an exercise session operation type"""
         self.handlers.setdefault(op_type, []).append(handler)
@@ -434,23 +634,25 @@ class ESMService:
             account_id=account_id,
             session_id=session_id,
             connected_at=now,
-            last_activity=now,
+            last_activity=now.timestamp(),
+            registry_key=registry_key_prefix + connection_id,
             instance_id=self.instance_id
         )
+        connection.writer_task = asyncio.create_task(self._write_outbox(connection_id, connection))
         
-        need_subscribe = False
-        async with self._lock:
-            self.connections[connection_id] = connection
-            self.account_connections.setdefault(account_id, set()).add(connection_id)
-            if session_id:
+        self.connections[connection_id] = connection
+        self.account_connections[account_id].add(connection_id)
+        self.stats.open_connections += 1
+        
+        if session_id:
+            async with self._slock(session_id):
                 created = session_id not in self.session_connections
-                self.session_connections.setdefault(session_id, set()).add(connection_id)
-                need_subscribe = created
-            self.stats.open_connections += 1
-        if need_subscribe:
-            await self.pubsub.subscribe(f"{psub_prefix}:session:{session_id}")
+                self.session_connections[session_id].add(connection_id)
+                self._snapshot_session(session_id)
+                if created:
+                    await self._subscribe_session(session_id)
             
-        await self._update_connection_registry(connection_id, connection)
+        self._update_connection_registry(connection_id, connection)
         logger.info(_makelog("opened connection id=%s account=%s session=%s"), connection_id, account_id, session_id)
         return connection_id
     
@@ -458,33 +660,35 @@ class ESMService:
     
     async def close_connection(self, connection_id: str):
         """Close an existing connection and remove it from the registry"""
-        async with self._lock:
-            connection = self.connections.get(connection_id)
-            if not connection:
-                return
-            
-            account_id = connection.account_id
-            session_id = connection.session_id
-            connections = self.account_connections.get(account_id)
+        connection = self.connections.pop(connection_id, None)
+        if not connection:
+            return
             
-            if connections:
-                connections.discard(connection_id)
-                if not connections:
-                    self.account_connections.pop(account_id, None)
+        account_id = connection.account_id
+        session_id = connection.session_id
+        connections = self.account_connections.get(account_id)
+        
+        if connections:
+            connections.discard(connection_id)
+            if not connections:
+                self.account_connections.pop(account_id, None)
             
-            if session_id:
+        self.stats.open_connections -= 1
+        
+        if session_id:
+            async with self._slock(session_id):
                 session_connections = self.session_connections.get(session_id)
                 if session_connections:
                     session_connections.discard(connection_id)
+                    self._snapshot_session(session_id)
                     if not session_connections:
                         self.session_connections.pop(session_id, None)
-                        if self.pubsub:
-                            await self.pubsub.unsubscribe(f"{psub_prefix}:session:{session_id}")
-            
-            self.connections.pop(connection_id, None)
-            self.stats.open_connections -= 1
+                        await self._unsubscribe_session(session_id)
+        
+        self._remove_connection_registry(connection_id, connection)
         
-        await self._remove_connection_registry(connection_id)
+        if connection.writer_task and connection.writer_task is not asyncio.current_task():
+            connection.writer_task.cancel()
         
         try:
             await connection.websocket.close()
@@ -497,30 +701,71 @@ class ESMService:
     
     async def send_to_connection(self, connection_id: str, operation: ExerciseSessionOperation):
         """Send an operation to a specific connection"""
-        async with self._lock:
-            connection = self.connections.get(connection_id)
+        await self.send_frame_to_connection(connection_id, self._encode(operation))
+    
+    
+    
+    async def send_frame_to_connection(self, connection_id: str, frame: Union[str, bytes]):
+        """Send an already encoded operation to a specific connection"""
+        self._enqueue_frame(connection_id, frame)
+    
+    
+    
+    def _enqueue_frame(self, connection_id: str, frame: Union[str, bytes]):
+        """Queue a frame on a connection's outbox, dropping the connection if it has fallen too far behind"""
+        connection = self.connections.get(connection_id)
+        if not connection or connection.closing:
+            return
         
-        if not connection:
+        if connection.outbox.qsize() >= self.outbox_limit:
+            # a client this far behind would only see stale state, let it reconnect and resync
+            logger.warning(_makelog("outbox full, dropping slow connection id=%s"), connection_id)
+            connection.closing = True
+            task = asyncio.create_task(self.close_connection(connection_id))
+            self._background_tasks.add(task)
+            task.add_done_callback(self._background_tasks.discard)
             return
         
-        try:
-            await connection.websocket.send_text(operation.json())
-            connection.last_activity = datetime.now(timezone.utc)
-        except Exception as e:
-            logger.error(_makelog("send_to_connection failed id=%s err=%s"), connection_id, e)
-            await self.close_connection(connection_id)
+        connection.outbox.put_nowait(frame)
+    
+    
+    
+    def _fanout(self, connection_ids: tuple[str, ...], frame: Union[str, bytes], exclude_connection: Optional[str] = None):
+        """Queue a frame on many connections' outboxes"""
+        for cid in connection_ids:
+            if cid != exclude_connection:
+                self._enqueue_frame(cid, frame)
+    
+    
+    
+    async def _write_outbox(self, connection_id: str, connection: ESMConnectionInfo):
+        """Write a connection's queued frames to its socket one at a time, in order"""
+        outbox = connection.outbox
+        websocket = connection.websocket
+        while True:
+            frame = await outbox.get()
+            try:
+                if isinstance(frame, bytes):
+                    await websocket.send_bytes(frame)
+                else:
+                    await websocket.send_text(frame)
+                connection.sent += 1
+                self.stats.outgoing_messages += 1
+            except Exception as e:
+                logger.error(_makelog("send_to_connection failed id=%s err=%s"), connection_id, e)
+                await self.close_connection(connection_id)
+                return
     
     
     
     async def send_to_account(self, account_id: str, operation: ExerciseSessionOperation):
         """Send an operation to all connections of a specific account"""
-        async with self._lock:
-            connections = list(self.account_connections.get(account_id, set()))
+        connections = tuple(self.account_connections.get(account_id, ()))
         
         if not connections:
             return
         
-        await asyncio.gather(*(self.send_to_connection(cid, operation) for cid in connections), return_exceptions=True)
+        self._fanout(connections, self._encode(operation))
     
     
     
@@ -529,42 +774,35 @@ class ESMService:
         if operation.instance_id is None:
             operation.instance_id = self.instance_id
         
-        channel = f"{psub_prefix}:session:{operation.session_id}"
-        await self.redis.publish(channel, operation.json())
-        
-        async with self._lock:
-            connections = list(self.session_connections.get(operation.session_id, ()))
+        channel = self.session_channels.get(operation.session_id) or f"{psub_prefix}:session:{operation.session_id}"
+        frame = self._encode(operation)
+        self._publish_queue.put_nowait((channel, frame))
         
+        connections = self.session_snapshots.get(operation.session_id, ())
         if not connections:
             return
         
-        tasks = []
-        for cid in connections:
-            if cid == exclude_connection:
-                continue
-            tasks.append(self.send_to_connection(cid, operation))
-        
-        await asyncio.gather(*tasks, return_exceptions=True)
+        self._fanout(connections, frame, exclude_connection)
     
 
     
     async def handle_client_op(self, connection_id: str, payload: Dict[str, Any]):
-        async with self._lock:
-            connection = self.connections.get(connection_id)
-            if not connection:
-                return
-            connection.last_activity = datetime.now(timezone.utc)
-            author_id = connection.account_id
-            default_session_id = connection.session_id or ""
+        connection = self.connections.get(connection_id)
+        if not connection:
+            return
+        now = datetime.now(timezone.utc)
+        connection.last_activity = now.timestamp()
+        author_id = connection.account_id
+        default_session_id = connection.session_id or ""
 
         try:
             op = ExerciseSessionOperation(
-                id=payload.get("id", str(uuid4())),
-                op_type=ExerciseSessionOperationType(payload["op_type"]),
+                id=payload.get("id") or str(uuid4()),
+                op_type=_OP_TYPES[payload["op_type"]],
                 session_id=payload.get("session_id", default_session_id),
                 author_id=author_id,
                 payload=payload.get("payload", {}),
-                timestamp=datetime.now(timezone.utc),
+                timestamp=now,
                 version=payload.get("version", 0),
                 instance_id=self.instance_id,
             )
@@ -595,14 +833,13 @@ class ESMService:
         if not self.running or self.pubsub is None:
             raise RuntimeError("start() must be called before join_session()")
         
-        async with self._lock:
-            connection = self.connections.get(connection_id)
-            if not connection:
-                return
-            old_session_id = connection.session_id
+        connection = self.connections.get(connection_id)
+        if not connection:
+            return
+        old_session_id = connection.session_id
         
         if old_session_id and old_session_id != operation.session_id:
-            await self.leave_session(connection_id=connection_id, operation=ExerciseSessionOperation(
+            await self.leave_session(connection_id=connection_id, operation=ExerciseSessionOperation.construct(
                 id=str(uuid4()),
                 author_id=operation.author_id,
                 session_id=old_session_id,
@@ -623,7 +860,7 @@ class ESMService:
             raise ValueError("Session ID must be provided for JOIN operation")
         
         author_id = operation.author_id
-        author = await self.account_repo.get_account_by_id(author_id)
+        author = await self._get_account(author_id)
         if not author:
             raise ValueError(f"Account with ID {author_id} does not exist")
         
@@ -634,18 +871,21 @@ class ESMService:
         if session.status != ExerciseSessionStatus.ACTIVE:
             raise ValueError(f"Session with ID {session_id} is not active")
         
-        async with self._lock:
-            connection = self.connections.get(connection_id)
-            if not connection:
-                return
-            connection.session_id = session_id
+        connection = self.connections.get(connection_id)
+        if not connection:
+            return
+        connection.session_id = session_id
+        
+        async with self._slock(session_id):
             created = session_id not in self.session_connections
-            self.session_connections.setdefault(session_id, set()).add(connection_id)
+            self.session_connections[session_id].add(connection_id)
+            self._snapshot_session(session_id)
             if created:
-                await self.pubsub.subscribe(f"{psub_prefix}:session:{session_id}")
+                await self._subscribe_session(session_id)
         
-        await self._update_connection_registry(connection_id, connection)
+        self._update_connection_registry(connection_id, connection)
         
+        now = datetime.now(timezone.utc)
         join_op = ExerciseSessionOperation(
             id=str(uuid4()),
             op_type=ExerciseSessionOperationType.PARTICIPANT_JOIN,
@@ -655,9 +895,9 @@ class ESMService:
                 "account_id": author_id,
                 "username": author.username,
                 "session_id": session_id,
-                "joined_at": datetime.now(timezone.utc).isoformat(),
+                "joined_at": now.isoformat(),
             },
-            timestamp=datetime.now(timezone.utc),
+            timestamp=now,
             version=0,
             instance_id=self.instance_id
         )
@@ -666,12 +906,12 @@ class ESMService:
         
         participants = []
         for participant in session.participants:
-            participant_account = await self.account_repo.get_account_by_id(participant.id)
+            participant_account = await self._get_account(participant.id)
             if participant_account:
                 participants.append({
                     "id": participant_account.id,
                     "username": participant_account.username,
-                    "color": participant.color if hasattr(participant, 'color') else "#FFFFFF"
+                    "color": participant.color
                 })
         
         welcome_op = ExerciseSessionOperation(
@@ -687,7 +927,7 @@ class ESMService:
                     "owner_id": session.owner_id
                 }
             },
-            timestamp=datetime.now(timezone.utc),
+            timestamp=now,
             version=0,
             instance_id=self.instance_id
         )
@@ -703,32 +943,33 @@ class ESMService:
         if not self.running or self.pubsub is None:
             raise RuntimeError("start() must be called before leave_session()")
         
-        async with self._lock:
-            connection = self.connections.get(connection_id)
-            if not connection:
-                return
-            
-            session_id = connection.session_id
-            account_id = connection.account_id
+        connection = self.connections.get(connection_id)
+        if not connection:
+            return
             
-            if not session_id:
-                return
+        session_id = connection.session_id
+        account_id = connection.account_id
+        
+        if not session_id:
+            return
 
-            connection.session_id = ""
-            
+        connection.session_id = ""
+        
+        async with self._slock(session_id):
             session_connections = self.session_connections.get(session_id)
             if session_connections:
                 session_connections.discard(connection_id)
+                self._snapshot_session(session_id)
                 if not session_connections:
                     self.session_connections.pop(session_id, None)
-                    if self.pubsub:
-                        await self.pubsub.unsubscribe(f"{psub_prefix}:session:{session_id}")
+                    await self._unsubscribe_session(session_id)
         
-        await self._update_connection_registry(connection_id, connection)
+        self._update_connection_registry(connection_id, connection)
         
-        author = await self.account_repo.get_account_by_id(account_id)
+        author = await self._get_account(account_id)
         username = author.username if author else "Unknown"
         
+        now = datetime.now(timezone.utc)
         leave_op = ExerciseSessionOperation(
             id=str(uuid4()),
             op_type=ExerciseSessionOperationType.PARTICIPANT_LEAVE,
@@ -738,9 +979,9 @@ class ESMService:
                 "account_id": account_id,
                 "username": username,
                 "session_id": session_id,
-                "left_at": datetime.now(timezone.utc).isoformat(),
+                "left_at": now.isoformat(),
             },
-            timestamp=datetime.now(timezone.utc),
+            timestamp=now,
             version=0,
             instance_id=self.instance_id,
         )
@@ -759,7 +1000,7 @@ class ESMService:
         session = await self._assert_session_active(operation.session_id)
         await self._assert_connection_in_session(connection_id, operation.session_id)
         
-        author = await self.account_repo.get_account_by_id(operation.author_id)
+        author = await self._get_account(operation.author_id)
         if not author:
             raise ValueError(f"Account with ID {operation.author_id} does not exist")
     
@@ -768,18 +1009,9 @@ class ESMService:
         except Exception as e:
             raise ValueError(f"Invalid payload for ADD_EXERCISE operation: {e}")
         
-        state = await self.session_repo.get_active_session_state_by_user(operation.author_id)
-        if not state:
-            state = await self.session_repo.create_session_state(operation.session_id, operation.author_id)
-        if not state:
-            raise ValueError(f"Session state for user {operation.author_id} not found")
-        
         if add_exercise_data.participants:
-            valid_participants = []
-            for participant_id in add_exercise_data.participants:
-                is_in_session = any(p.id == participant_id for p in session.participants)
-                if is_in_session:
-                    valid_participants.append(participant_id)
+            session_participant_ids = {p.id for p in session.participants}
+            valid_participants = [pid for pid in add_exercise_data.participants if pid in session_participant_ids]
             
             participants = valid_participants if valid_participants else [operation.author_id]
         else:
@@ -788,35 +1020,44 @@ class ESMService:
         if not isinstance(add_exercise_data.meta, list):
             raise ValueError("Meta must be a list of ExerciseMeta objects")
         
-        meta: list[ExerciseSessionItemMeta] = []
-        for m in add_exercise_data.meta:
-            if not m.id:
-                continue
+        # fields below all come from the already validated AddExerciseOperation, so skip re-validating them
+        meta = [
+            ExerciseSessionItemMeta.construct(internal_id=m.id, name=m.name, type=m.type)
+            for m in add_exercise_data.meta
+            if m.id
+        ]
+        
+        # writers on any instance may race on the same state, so only write back over the version we read
+        for _ in range(state_write_attempts):
+            state = await self.session_repo.get_active_session_state_by_user(operation.author_id)
+            if not state:
+                state = await self.session_repo.create_session_state(operation.session_id, operation.author_id)
+            if not state:
+                raise ValueError(f"Session state for user {operation.author_id} not found")
             
-            meta.append(ExerciseSessionItemMeta(
-                internal_id=m.id,
-                name=m.name,
-                type=m.type
-            ))
-        
-        new_item = ExerciseSessionStateItem(
-            id=str(uuid4()),
-            order=len(state.items) + 1,
-            participants=participants,
-            type=add_exercise_data.set_type,
-            rest=-1,
-            meta=meta,
-            sets=[]
-        )
-        
-        state.items.append(new_item)
-        state.version += 1
-        
-        await self.session_repo.update_session_state(state)
+            new_item = ExerciseSessionStateItem.construct(
+                id=str(uuid4()),
+                order=len(state.items) + 1,
+                participants=participants,
+                type=add_exercise_data.set_type,
+                rest=-1,
+                meta=meta,
+                sets=[]
+            )
+            
+            expected_version = state.version
+            state.items.append(new_item)
+            state.version += 1
+            
+            if await self.session_repo.update_session_state_if_version(state, expected_version):
+                break
+        else:
+            raise ValueError(f"Session state for user {operation.author_id} changed concurrently, try again")
         
+        now = datetime.now(timezone.utc)
         res = AddExerciseResponse(
             exercise=new_item,
-            added_at=datetime.now(timezone.utc),
+            added_at=now,
             added_by=AccountIdentifier(
                 id=operation.author_id,
                 username=author.username
@@ -830,7 +1071,7 @@ class ESMService:
             session_id=operation.session_id,
             author_id=operation.author_id,
             payload=res.dict(),
-            timestamp=datetime.now(timezone.utc),
+            timestamp=now,
             version=state.version,
             instance_id=self.instance_id,
         )
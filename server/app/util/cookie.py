@@ -2,24 +2,20 @@ from fastapi import Response
 from app.config import settings
 
 def set_auth_cookies(res: Response, access_token: str, refresh_token: str):
+    common = {"httponly": True, "secure": settings.is_prod(), "samesite": "lax", "path": "/"}
+    
     res.set_cookie(
         key="access_token",
         value=access_token,
-        httponly=True,
-        secure=settings.is_prod(),
-        samesite="lax",
         max_age=settings.access_token_ttl_minutes * 60,
-        path="/"
+        **common
     )
     
     res.set_cookie(
         key="refresh_token",
         value=refresh_token,
-        httponly=True,
-        secure=settings.is_prod(),
-        samesite="lax",
         max_age=settings.refresh_token_ttl_minutes * 60,
-        path="/"
+        **common
     )
 
 def clear_auth_cookies(res: Response):
@@ -1,7 +1,9 @@
 from argon2 import PasswordHasher
-from argon2.exceptions import VerifyMismatchError
+from argon2.exceptions import VerificationError, InvalidHashError
+from argon2.profiles import RFC_9106_LOW_MEMORY
 
-password_hasher = PasswordHasher()
+# pinned so a library upgrade can't silently change the cost of new hashes
+password_hasher = PasswordHasher.from_parameters(RFC_9106_LOW_MEMORY)
 
 class Hasher:
     @staticmethod
@@ -12,5 +14,5 @@ class Hasher:
     def verify(compared: str, value: str) -> bool:
         try:
             return password_hasher.verify(compared, value)
-        except VerifyMismatchError:
+        except (VerificationError, InvalidHashError):
             return False
\ No newline at end of file
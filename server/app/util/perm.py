@@ -4,9 +4,8 @@ from app.schema.account import AccountInDB
 
 class Permissions:
     @staticmethod
-    async def has_permission(roles: List[Role], permission: Permission) -> bool:
+    def has_permission(roles: List[Role], permission: Permission) -> bool:
         if not roles:
             return False
         
-        all = {p for r in roles for p in r.permissions}
-        return permission in all
\ No newline at end of file
+        return any(permission in r.permissions for r in roles)
\ No newline at end of file
@@ -1,17 +1,30 @@
 from typing import Union, List
 import re
+import string
 
-_allowed_pattern = re.compile(r"[^a-zA-Z0-9\-]+")
+class _DropTable(dict):
+    def __missing__(self, key: int) -> None:
+        return None
+
+_allowed_chars = string.ascii_lowercase + string.digits + "-"
+# keeps [a-z0-9-] and drops everything else in a single translate pass
+_allowed_table = _DropTable({i: None for i in range(128)})
+_allowed_table.update({ord(c): ord(c) for c in _allowed_chars})
+# ascii input skips unicode handling, bytes.translate drops then lowercases in one C pass
+_ascii_lower = bytes.maketrans(string.ascii_uppercase.encode(), string.ascii_lowercase.encode())
+_ascii_drop = bytes(b for b in range(128) if chr(b) not in _allowed_chars and chr(b) not in string.ascii_uppercase)
+_dash_run_pattern = re.compile(r"-{2,}")
 
 def _sanitize_str(value: str) -> str:
-    cleaned = value.lower()
-    cleaned = _allowed_pattern.sub("", cleaned)
-    cleaned = re.sub(r"-{2,}", "-", cleaned)
-    cleaned = re.sub(r"\s+", " ", cleaned)
+    if value.isascii():
+        cleaned = value.encode().translate(_ascii_lower, _ascii_drop).decode()
+    else:
+        cleaned = value.lower().translate(_allowed_table)
+    cleaned = _dash_run_pattern.sub("-", cleaned)
     return cleaned.strip("-")
 
 def sanitize_str(text: str) -> str:
     return _sanitize_str(text)
 
 def sanitize_str_list(text: List[str]) -> List[str]:
-    return [_sanitize_str(t) for t in text if isinstance(t, str)]
\ No newline at end of file
+    return [_sanitize_str(t) for t in text if isinstance(t, str)]
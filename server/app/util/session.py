@@ -3,26 +3,77 @@ from typing import Optional, Dict, Any, List
 from app.db.redis import Redis
 from datetime import datetime, timezone, timedelta
 from app.config import settings
-from json import dumps, loads
+import ipaddress
 import logging
+import orjson
 
 logger = logging.getLogger(__name__)
 
+access_ttl_s = settings.access_token_ttl_minutes * 60
+refresh_ttl_s = settings.refresh_token_ttl_minutes * 60
+cleanup_batch_size = 500
+# refreshes last_active (and ip_address when it changed) in place, returns 0 if the session is gone
+update_session_lua = """
+local raw = redis.call("GET", KEYS[1])
+if not raw then return 0 end
+local data = cjson.decode(raw)
+local previous_ip = data.ip_address
+if previous_ip == nil or previous_ip == cjson.null then previous_ip = "" end
+data.last_active = ARGV[1]
+if ARGV[2] ~= "" and ARGV[2] ~= previous_ip then data.ip_address = ARGV[2] end
+redis.call("SET", KEYS[1], cjson.encode(data), "EX", ARGV[3])
+local username = data.username
+if username == nil or username == cjson.null then username = "" end
+return {previous_ip, username}
+"""
+_update_session_script = None
+# SCAN page size, the server default of 10 means a round-trip per 10 keys
+scan_count = 1000
+private_ip_networks = tuple(
+    ipaddress.ip_network(cidr) for cidr in ("10.0.0.0/8", "172.16.0.0/12", "192.168.0.0/16", "127.0.0.0/8")
+)
+
+def _get_update_session_script(redis: Redis):
+    # registered once per client, re-registered only if the client was replaced on reconnect
+    global _update_session_script
+    client = redis.get_client()
+    if _update_session_script is None or _update_session_script.registered_client is not client:
+        _update_session_script = client.register_script(update_session_lua)
+    return _update_session_script
+
+def _is_private_ip(ip: str) -> bool:
+    try:
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    return any(addr in network for network in private_ip_networks)
+
+async def _get_json(redis: Redis, key: str) -> Optional[Dict[str, Any]]:
+    raw = await redis.get(key)
+    return orjson.loads(raw) if raw else None
+
 def get_client_info(request: Request) -> dict:
-    forwarded_for = request.headers.get("X-Forwarded-For")
-    real_ip = request.headers.get("X-Real-IP")
+    # parsed once per request, dependencies and handlers both ask for it
+    cached = getattr(request.state, "client_info", None)
+    if cached is not None:
+        return cached
+    
+    headers = request.headers
+    forwarded_for = headers.get("X-Forwarded-For")
     
     if forwarded_for:
-        ip = forwarded_for.split(",")[0].strip()
-    elif real_ip:
+        ip = forwarded_for.partition(",")[0].strip()
+    elif real_ip := headers.get("X-Real-IP"):
         ip = real_ip
     elif request.client:
         ip = request.client.host
     else:
         ip = ""
     
-    user_agent = request.headers.get("User-Agent", "")
-    return {"ip": ip, "user_agent": user_agent}
+    user_agent = headers.get("User-Agent", "")
+    info = {"ip": ip, "user_agent": user_agent}
+    request.state.client_info = info
+    return info
 
 class Sessions:
     @staticmethod
@@ -37,14 +88,14 @@ class Sessions:
         device_info: Optional[Dict[str, Any]] = None,
     ) -> Dict[str, Any]:
         try:
-            now = datetime.now(tz=timezone.utc)
+            now = datetime.now(tz=timezone.utc).isoformat()
             data = {
                 "account_id": account_id,
                 "username": username,
                 "email": email,
                 "session_type": session_type,
-                "created_at": now.isoformat(),
-                "last_active": now.isoformat(),
+                "created_at": now,
+                "last_active": now,
                 "ip_address": ip,
                 "user_agent": user_agent,
                 "device_info": device_info or {},
@@ -52,10 +103,9 @@ class Sessions:
             }
             
             key = f"session:{session_type}:{account_id}"
-            ttl = (settings.access_token_ttl_minutes if session_type == 'access'
-                   else settings.refresh_token_ttl_minutes) * 60
+            ttl = access_ttl_s if session_type == 'access' else refresh_ttl_s
             
-            await redis.setex(key, ttl, dumps(data))
+            await redis.setex(key, ttl, orjson.dumps(data))
             await Sessions._add(redis, account_id, session_type, data)
             
             logger.info(f"Session created for user {username} ({session_type})")
@@ -73,7 +123,7 @@ class Sessions:
     ) -> Optional[Dict[str, Any]]:
         try:
             key = f"session:{session_type}:{account_id}"
-            data = await redis.get(key, decode_json=True)
+            data = await _get_json(redis, key)
             return data
         except Exception as e:
             logger.error(f"Failed to get session: {e}")
@@ -88,22 +138,18 @@ class Sessions:
     ) -> bool:
         try:
             key = f"session:{session_type}:{account_id}"
-            data = await redis.get(key, decode_json=True)
-            
-            if not data:
-                return False
-            
+            ttl = access_ttl_s if session_type == 'access' else refresh_ttl_s
             now = datetime.now(tz=timezone.utc)
-            data["last_active"] = now.isoformat()
             
-            if ip and ip != data.get("ip_address"):
-                data["ip_address"] = ip
-                logger.warning(f"IP changed for user {data.get('username')}: {ip}")
+            script = _get_update_session_script(redis)
+            result = await script(keys=[key], args=[now.isoformat(), ip or "", ttl])
+            if not result:
+                return False
             
-            ttl = (settings.access_token_ttl_minutes if session_type == 'access'
-                   else settings.refresh_token_ttl_minutes) * 60
+            previous_ip, username = result
+            if ip and ip != previous_ip:
+                logger.warning(f"IP changed for user {username}: {ip}")
             
-            await redis.setex(key, ttl, dumps(data))
             return True
             
         except Exception as e:
@@ -118,14 +164,15 @@ class Sessions:
     ) -> bool:
         try:
             key = f"session:{session_type}:{account_id}"
-            data = await redis.get(key, decode_json=True)
+            data = await _get_json(redis, key)
             
             if data:
+                now = datetime.now(tz=timezone.utc)
                 data["is_active"] = False
-                data["invalidated_at"] = datetime.now(tz=timezone.utc).isoformat()
+                data["invalidated_at"] = now.isoformat()
                 
-                inv_key = f"invalidated_session:{session_type}:{account_id}:{int(datetime.now().timestamp())}"
-                await redis.setex(inv_key, 3600, dumps(data))
+                inv_key = f"invalidated_session:{session_type}:{account_id}:{int(now.timestamp())}"
+                await redis.setex(inv_key, 3600, orjson.dumps(data))
             
             result = await redis.delete(key)
             await Sessions._rem(redis, account_id, session_type)
@@ -143,17 +190,29 @@ class Sessions:
         account_id: str
     ) -> bool:
         try:
-            success = True
+            session_types = ['access', 'refresh']
+            keys = [f"session:{session_type}:{account_id}" for session_type in session_types]
+            now = datetime.now(tz=timezone.utc)
             
-            for session_type in ['access', 'refresh']:
-                result = await Sessions.invalidate(redis, account_id, session_type)
-                success = success and result
+            # one read for both sessions, then one pipeline for every write
+            pipe = redis.pipeline(transaction=False)
+            for session_type, key, raw in zip(session_types, keys, await redis.mget(*keys)):
+                if raw:
+                    data = orjson.loads(raw)
+                    data["is_active"] = False
+                    data["invalidated_at"] = now.isoformat()
+                    
+                    inv_key = f"invalidated_session:{session_type}:{account_id}:{int(now.timestamp())}"
+                    pipe.setex(inv_key, 3600, orjson.dumps(data))
             
-            await redis.delete(f"user:{account_id}")
-            await redis.delete(f"active_sessions:{account_id}")
+            delete_index = len(pipe)
+            pipe.delete(*keys)
+            pipe.delete(f"user:{account_id}", f"active_sessions:{account_id}")
+            results = await pipe.execute()
             
-            logger.info(f"All sessions invalidated for account {account_id}")
-            return success
+            # a session that already expired is not a failure, the count is only worth logging
+            logger.info(f"All sessions invalidated for account {account_id} ({results[delete_index]} deleted)")
+            return True
             
         except Exception as e:
             logger.error(f"Failed to invalidate all sessions: {e}")
@@ -165,14 +224,9 @@ class Sessions:
         account_id: str
     ) -> List[Dict[str, Any]]:
         try:
-            sessions = []
-            
-            for session_type in ['access', 'refresh']:
-                data = await Sessions.get(redis, account_id, session_type)
-                if data and data.get("is_active", True):
-                    sessions.append(data)
-            
-            return sessions
+            raws = await redis.mget(f"session:access:{account_id}", f"session:refresh:{account_id}")
+            sessions = [orjson.loads(raw) for raw in raws if raw]
+            return [data for data in sessions if data.get("is_active", True)]
             
         except Exception as e:
             logger.error(f"Failed to get active sessions: {e}")
@@ -184,22 +238,16 @@ class Sessions:
             cleaned = 0
             client = redis.get_client()
             
-            # Get all session keys
-            keys = []
-            async for key in client.scan_iter(match="session:*"):
-                keys.append(key)
+            cutoff = datetime.now(tz=timezone.utc) - timedelta(hours=24)
+            batch: List[str] = []
+            async for key in client.scan_iter(match="session:*", count=scan_count):
+                batch.append(key)
+                if len(batch) >= cleanup_batch_size:
+                    cleaned += await Sessions._cleanup_batch(redis, batch, cutoff)
+                    batch = []
             
-            for key in keys:
-                if not await redis.exists(key):
-                    cleaned += 1
-                    continue
-                
-                data = await redis.get(key, decode_json=True)
-                if data:
-                    last_active = datetime.fromisoformat(data.get("last_active", ""))
-                    if datetime.now(tz=timezone.utc) - last_active > timedelta(hours=24):
-                        await redis.delete(key)
-                        cleaned += 1
+            if batch:
+                cleaned += await Sessions._cleanup_batch(redis, batch, cutoff)
             
             logger.info(f"Cleaned up {cleaned} expired sessions")
             return cleaned
@@ -208,6 +256,26 @@ class Sessions:
             logger.error(f"Failed to cleanup expired sessions: {e}")
             return 0
     
+    @staticmethod
+    async def _cleanup_batch(redis: Redis, keys: List[str], cutoff: datetime) -> int:
+        cleaned = 0
+        expired = []
+        
+        for key, raw in zip(keys, await redis.mget(*keys)):
+            if not raw:
+                cleaned += 1
+                continue
+            
+            data = orjson.loads(raw)
+            if datetime.fromisoformat(data.get("last_active", "")) < cutoff:
+                expired.append(key)
+        
+        if expired:
+            await redis.delete(*expired)
+            cleaned += len(expired)
+        
+        return cleaned
+    
     @staticmethod
     async def get_stats(
         redis: Redis,
@@ -224,14 +292,18 @@ class Sessions:
             if account_id:
                 sessions = await Sessions.get_active(redis, account_id)
                 stats["total_active"] = len(sessions)
-                stats["access_sessions"] = len([s for s in sessions if s.get("session_type") == "access"])
-                stats["refresh_sessions"] = len([s for s in sessions if s.get("session_type") == "refresh"])
+                for session in sessions:
+                    session_type = session.get("session_type")
+                    if session_type == "access":
+                        stats["access_sessions"] += 1
+                    elif session_type == "refresh":
+                        stats["refresh_sessions"] += 1
                 stats["unique_users"] = 1 if sessions else 0
             else:
                 client = redis.get_client()
                 users = set()
                 
-                async for key in client.scan_iter(match="session:*"):
+                async for key in client.scan_iter(match="session:*", count=scan_count):
                     key_str = key.decode() if isinstance(key, bytes) else key
                     parts = key_str.split(":")
                     if len(parts) >= 3:
@@ -291,6 +363,7 @@ class Sessions:
     ):
         try:
             key = f"active_sessions:{account_id}"
+            # keep "type" first, _rem matches members on it
             info = {
                 "type": session_type,
                 "created_at": data["created_at"],
@@ -298,8 +371,8 @@ class Sessions:
                 "user_agent": data.get("user_agent")
             }
             
-            await redis.sadd(key, dumps(info))
-            await redis.expire(key, settings.refresh_token_ttl_minutes * 60)
+            await redis.sadd(key, orjson.dumps(info))
+            await redis.expire(key, refresh_ttl_s)
             
         except Exception as e:
             logger.error(f"Failed to add to active sessions: {e}")
@@ -312,17 +385,15 @@ class Sessions:
     ):
         try:
             key = f"active_sessions:{account_id}"
-            members = await redis.smembers(key)
-            
-            for member in members:
-                try:
-                    info = loads(member)
-                    if info.get("type") == session_type:
-                        await redis.srem(key, member)
-                        break
-                except Exception:
-                    continue
-                    
+            client = redis.get_client()
+            # compact orjson members, plus members written by json.dumps before the switch
+            members = []
+            for match in (f'{{"type":"{session_type}",*', f'{{"type": "{session_type}",*'):
+                members.extend([m async for m in client.sscan_iter(key, match=match)])
+            
+            if members:
+                await redis.srem(key, *members)
+            
         except Exception as e:
             logger.error(f"Failed to remove from active sessions: {e}")
 
@@ -367,10 +438,9 @@ class SessionSecurity:
                 score += 40
                 alerts.append("Rapid session creation")
             
-            private_prefixes = ["192.168.", "10.", "172.16.", "127."]
-            public_ips = [ip for ip in ips if not any(ip.startswith(p) for p in private_prefixes)]
+            public_ips = sum(1 for ip in ips if not _is_private_ip(ip))
             
-            if len(public_ips) > 1:
+            if public_ips > 1:
                 score += 25
                 alerts.append("Multiple public IPs")
             
@@ -398,17 +468,14 @@ class SessionSecurity:
             if activity["score"] > 50:
                 return True
             
-            trusted_key = f"trusted_ips:{account_id}"
-            trusted_ips = await redis.smembers(trusted_key)
-            
-            if ip not in trusted_ips:
-                recent_key = f"recent_ips:{account_id}"
-                recent_ips = await redis.smembers(recent_key)
-                
-                if len(recent_ips) > 0 and ip not in recent_ips:
-                    return True
+            recent_key = f"recent_ips:{account_id}"
+            pipe = redis.pipeline(transaction=False)
+            pipe.sismember(f"trusted_ips:{account_id}", ip)
+            pipe.sismember(recent_key, ip)
+            pipe.scard(recent_key)
+            trusted, recent, recent_count = await pipe.execute()
             
-            return False
+            return not trusted and recent_count > 0 and not recent
             
         except Exception as e:
             logger.error(f"Failed to check if should challenge: {e}")
@@ -449,13 +516,14 @@ class SessionSecurity:
                 "details": details
             }
             
+            raw = orjson.dumps(event).decode()
             user_log_key = f"security_log:{account_id}"
-            await redis.lpush(user_log_key, dumps(event))
+            await redis.lpush(user_log_key, raw)
             await redis.ltrim(user_log_key, 0, 99)  # Keep last 100
             await redis.expire(user_log_key, 30 * 24 * 3600)  # 30 days
             
             global_log_key = "global_security_events"
-            await redis.lpush(global_log_key, dumps(event))
+            await redis.lpush(global_log_key, raw)
             await redis.ltrim(global_log_key, 0, 999)  # Keep last 1000
             await redis.expire(global_log_key, 7 * 24 * 3600)  # 7 days
             
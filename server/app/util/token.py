@@ -1,14 +1,38 @@
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
 from typing import Optional, Dict, Any
-from json import dumps
+from calendar import timegm
+from hashlib import sha256
 from app.config import settings
+import base64
+import hmac
 import jwt
+import orjson
+
+def _b64(value: bytes) -> bytes:
+    return base64.urlsafe_b64encode(value).rstrip(b"=")
+
+# the header and keyed hmac state never change, only the payload is encoded per token
+_header = _b64(orjson.dumps({"alg": "HS256", "typ": "JWT"}))
+_access_hmac = hmac.new(settings.access_token_secret.encode(), digestmod=sha256)
+_refresh_hmac = hmac.new(settings.refresh_token_secret.encode(), digestmod=sha256)
+
+def _encode(payload: Dict[str, Any], key: hmac.HMAC) -> str:
+    # NumericDate claims go out as epoch seconds, the same as jwt.encode does
+    for claim in ("exp", "iat", "nbf"):
+        value = payload.get(claim)
+        if isinstance(value, datetime):
+            payload[claim] = timegm(value.utctimetuple())
+    
+    signing_input = _header + b"." + _b64(orjson.dumps(payload))
+    signature = key.copy()
+    signature.update(signing_input)
+    return (signing_input + b"." + _b64(signature.digest())).decode()
 
 class Tokenizer:
     @staticmethod
     def create_access_token(id: str, additional_claims: Optional[Dict[str, Any]] = None):
-        now = datetime.now(tz=timezone.utc)
-        exp = now + timedelta(minutes=settings.access_token_ttl_minutes)
+        now = int(datetime.now(tz=timezone.utc).timestamp())
+        exp = now + settings.access_token_ttl_minutes * 60
         payload = {
             "sub": id,
             "iat": now,
@@ -19,12 +43,12 @@ class Tokenizer:
         if additional_claims:
             payload.update(additional_claims)
         
-        return jwt.encode(payload, settings.access_token_secret, algorithm="HS256")
+        return _encode(payload, _access_hmac)
     
     @staticmethod
     def create_refresh_token(id: str, additional_claims: Optional[Dict[str, Any]] = None):
-        now = datetime.now(tz=timezone.utc)
-        exp = now + timedelta(minutes=settings.refresh_token_ttl_minutes)
+        now = int(datetime.now(tz=timezone.utc).timestamp())
+        exp = now + settings.refresh_token_ttl_minutes * 60
         payload = {
             "sub": id,
             "iat": now,
@@ -35,7 +59,7 @@ class Tokenizer:
         if additional_claims:
             payload.update(additional_claims)
         
-        return jwt.encode(payload, settings.refresh_token_secret, algorithm="HS256")
+        return _encode(payload, _refresh_hmac)
     
     @staticmethod
     def decode_access_token(token: str) -> Optional[Dict[str, Any]]:
@@ -67,11 +91,15 @@ class Tokenizer:
     
     @staticmethod
     def decode_token(token: str) -> Optional[Dict[str, Any]]:
-        result = Tokenizer.decode_access_token(token)
-        if result:
-            return result
+        # pick the secret from the claimed type so every token is verified exactly once
+        try:
+            claimed = jwt.decode(token, options={"verify_signature": False})
+        except jwt.InvalidTokenError:
+            return None
         
-        return Tokenizer.decode_refresh_token(token)
+        if claimed.get("type") == "refresh":
+            return Tokenizer.decode_refresh_token(token)
+        return Tokenizer.decode_access_token(token)
     
     @staticmethod
     def get_user_id_from_token(token: str) -> Optional[str]: